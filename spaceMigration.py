@@ -2,13 +2,33 @@
 # -*- coding: utf-8 -*-
 
 import os
-import io
-import time
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import queue
+import threading
 import json
 import math
 import typing as t
-from urllib.parse import urljoin, quote
+from collections import defaultdict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urljoin
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary
+from urllib3.util.retry import Retry
+
+try:  # optional, much faster JSON for large body.storage payloads
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    _loads = json.loads
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
 
 # =========================
 # ===== CONFIGURATION =====
@@ -29,12 +49,27 @@ DST_API_TOKEN  = "<your_PAT_token>"
 COPY_ATTACHMENTS = True
 COPY_LABELS      = True
 
+# --- Local cache (re-runs only fetch what changed on the source) ---
+# Opt-in: keeps a copy of every page body and attachment of the space on disk.
+USE_CACHE  = False
+CACHE_DIR  = ".migration_cache"   # one sub-directory per source site + space
+
 # --- Behavior ---
 ON_TITLE_CONFLICT = "update"     # "skip" | "update" | "append-suffix"
+DEDUP_MIN_BYTES   = 4096         # bodies at least this large are cloned, not re-sent, when repeated
 PAGE_LIMIT        = 200          # pagination page size (<=200 typical)
 RETRY_MAX         = 6            # retries on 429/5xx
 RETRY_BASE_WAIT   = 2.0          # seconds (exponential backoff base)
 TIMEOUT_S         = 60           # per-request timeout
+MAX_WORKERS       = 16           # pages copied concurrently
+ATTACHMENT_WORKERS = 8           # attachments copied concurrently, across all pages
+
+# --- Derived (computed once; do not edit) ---
+SRC_ROOT    = SRC_BASE_URL.rstrip("/")
+SRC_API     = SRC_ROOT + "/rest/api"
+DST_API     = DST_BASE_URL.rstrip("/") + "/rest/api"
+DST_PAGES_CQL = f'space="{DST_SPACE_KEY}" AND type=page'
+POOL_MAXSIZE  = 2 * MAX_WORKERS + ATTACHMENT_WORKERS   # connections kept per host
 
 # =========================
 # ====== HTTP HELPERS =====
@@ -42,101 +77,200 @@ TIMEOUT_S         = 60           # per-request timeout
 def _session(user: str, token: str) -> requests.Session:
     s = requests.Session()
     s.auth = (user, token)
-    s.headers.update({"Accept": "application/json"})
+    # The default Accept-Encoding (urllib3's) already offers br and zstd when
+    # brotli/brotlicffi or zstandard is installed
+    s.headers.update({
+        "Accept": "application/json",
+        "Connection": "keep-alive",
+    })
+    # 429/5xx and connection errors are retried by urllib3 with exponential
+    # backoff, honouring Retry-After; the last response is returned, not raised.
+    retry = Retry(
+        total=RETRY_MAX,
+        backoff_factor=RETRY_BASE_WAIT,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST", "PUT", "DELETE"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    # Size the pool for concurrent page/label/attachment traffic so connections
+    # are reused instead of being re-opened (and re-handshaked) once it saturates.
+    # Peak per host: two source-side lookups per page worker (or one write
+    # on the destination), plus every attachment transfer.
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
     return s
 
-def _req_with_retry(sess: requests.Session, method: str, url: str, **kw) -> requests.Response:
-    # Basic 429/5xx retry with exponential backoff and Retry-After support.
-    for attempt in range(1, RETRY_MAX + 1):
-        try:
-            r = sess.request(method, url, timeout=TIMEOUT_S, **kw)
-        except requests.RequestException as e:
-            if attempt >= RETRY_MAX:
-                raise
-            wait = RETRY_BASE_WAIT * (2 ** (attempt - 1))
-            time.sleep(wait)
-            continue
-
-        if r.status_code == 429:
-            ra = r.headers.get("Retry-After")
-            wait = float(ra) if ra else RETRY_BASE_WAIT * (2 ** (attempt - 1))
-            time.sleep(wait)
-            continue
-        if 500 <= r.status_code < 600:
-            if attempt >= RETRY_MAX:
-                return r
-            wait = RETRY_BASE_WAIT * (2 ** (attempt - 1))
-            time.sleep(wait)
-            continue
-
-        return r
-    # should not reach here
-    return r
-
-def _paged_get(sess: requests.Session, url: str) -> t.Iterator[dict]:
+def _paged_get(sess: requests.Session, path: str, params: dict | None) -> t.Iterator[dict]:
     """
-    Iterate v1 paginated responses using start/limit and _links.next
+    Iterate v1 paginated responses. `params` are sent with the first request;
+    later pages follow _links.next, which already carries the full query
+    (including the cursor that CQL search uses instead of start).
     """
-    next_url = url
-    while next_url:
-        r = _req_with_retry(sess, "GET", next_url)
+    url: str | None = path
+    while url:
+        r = sess.get(url, params=params, timeout=TIMEOUT_S)
         r.raise_for_status()
-        data = r.json()
-        for item in data.get("results", []):
-            yield item
-        # _links.next is relative path
-        next_rel = data.get("_links", {}).get("next")
-        if next_rel:
-            base = data.get("_links", {}).get("base", "")
-            # Prefer absolute: base + next
-            next_url = base.rstrip("/") + next_rel
-        else:
-            next_url = None
+        data = _loads(r.content)
+        yield from data.get("results", [])
+        # _links.next is relative to _links.base
+        links = data.get("_links", {})
+        next_rel = links.get("next")
+        url = links.get("base", "").rstrip("/") + next_rel if next_rel else None
+        params = None
+
+# =========================
+# ====== LOCAL CACHE ======
+# =========================
+class SourceCache:
+    """
+    On-disk cache of source page bodies (SQLite) and attachment blobs (files),
+    both keyed by version.number so a stale entry is never served.
+    Each source site + space gets its own directory under `root`.
+    Safe to share between worker threads.
+    """
+    def __init__(self, root: str, site_url: str, space_key: str):
+        ns = hashlib.blake2b(f"{site_url}|{space_key}".encode("utf-8"), digest_size=8).hexdigest()
+        base = os.path.join(root, f"{space_key}-{ns}")
+        self.blob_dir = os.path.join(base, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(base, "pages.sqlite"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pages "
+            "(src_id TEXT PRIMARY KEY, version INTEGER NOT NULL, storage TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+
+    def has_full_listing(self) -> bool:
+        """True once a listing with bodies has been read to the end into this cache."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT 1 FROM meta WHERE key = 'full_listing'"
+            ).fetchone() is not None
+
+    def mark_full_listing(self):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('full_listing', '1')")
+
+    def get_page(self, src_id: str, version: int | None) -> str | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT storage FROM pages WHERE src_id = ? AND version = ?", (src_id, version)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_pages(self, rows: list[tuple[str, int | None, str]]):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO pages (src_id, version, storage) VALUES (?, ?, ?)", rows
+            )
+
+    def blob_path(self, att_id: str, version: int) -> str:
+        return os.path.join(self.blob_dir, f"{att_id}_{version}.bin")
+
+    def prune_blobs(self, att_id: str, version: int):
+        """Delete the blobs of older versions of an attachment."""
+        prefix = f"{att_id}_"
+        for name in os.listdir(self.blob_dir):
+            old = name[len(prefix):-len(".bin")]
+            if name.startswith(prefix) and name.endswith(".bin") and old.isdigit() and int(old) < version:
+                try:
+                    os.unlink(os.path.join(self.blob_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        self._db.close()
 
 # =========================
 # ====== CORE LOGIC =======
 # =========================
-def fetch_all_pages_from_space(src_sess: requests.Session) -> list[dict]:
+def _storage(p: dict) -> str:
+    return p.get("body", {}).get("storage", {}).get("value", "") or ""
+
+def _version(item: dict) -> int | None:
+    return (item.get("version") or {}).get("number")
+
+def iter_pages_from_space(
+    src_sess: requests.Session, cache: SourceCache | None = None
+) -> t.Iterator[dict]:
     """
-    Pull all pages from the source space with storage & ancestors expanded.
+    Stream the pages of the source space with ancestors & version expanded,
+    one listing page at a time.
+    Bodies come with the listing unless an earlier run has cached a complete one;
+    then they are resolved per page by page_storage() and only changed pages hit the source.
     """
-    q = (
-        f"{SRC_BASE_URL.rstrip('/')}/rest/api/content"
-        f"?type=page&spaceKey={quote(SRC_SPACE_KEY)}"
-        f"&expand=body.storage,ancestors,version"
-        f"&limit={PAGE_LIMIT}"
-    )
-    pages = list(_paged_get(src_sess, q))
-    return pages
+    lazy_bodies = cache is not None and cache.has_full_listing()
+    expand = "ancestors,version" if lazy_bodies else "body.storage,ancestors,version"
+    params = {"type": "page", "spaceKey": SRC_SPACE_KEY, "expand": expand, "limit": PAGE_LIMIT}
+    for p in _paged_get(src_sess, f"{SRC_API}/content", params):
+        if cache is not None and not lazy_bodies:
+            cache.put_pages([(p["id"], _version(p), _storage(p))])
+        yield p
+    if cache is not None and not lazy_bodies:
+        cache.mark_full_listing()
+
+def page_storage(src_sess: requests.Session, p: dict, cache: SourceCache | None) -> str:
+    """
+    Storage-format body of a source page: from the listing, else the cache, else the source.
+    """
+    if "body" in p:
+        return _storage(p)
+    version = _version(p)
+    storage = cache.get_page(p["id"], version) if cache is not None else None
+    if storage is None:
+        r = src_sess.get(f"{SRC_API}/content/{p['id']}",
+                         params={"expand": "body.storage,version"}, timeout=TIMEOUT_S)
+        r.raise_for_status()
+        fresh = _loads(r.content)
+        storage = _storage(fresh)
+        if cache is not None:
+            cache.put_pages([(p["id"], _version(fresh), storage)])
+    return storage
 
-def sort_pages_parent_first(pages: list[dict]) -> list[dict]:
-    # Use number of ancestors as depth; parents (smaller depth) first
-    def depth(p: dict) -> int:
-        return len(p.get("ancestors", []) or [])
-    return sorted(pages, key=depth)
+def _parent_id(p: dict) -> str | None:
+    ancestors = p.get("ancestors", []) or []
+    return ancestors[-1]["id"] if ancestors else None
 
-def find_dest_page_by_title(
-    dst_sess: requests.Session, title: str, parent_id: str | None
-) -> dict | None:
+def _digest(storage_value: str) -> bytes:
+    return hashlib.blake2b(storage_value.encode("utf-8"), digest_size=16).digest()
+
+def prefetch_dest_index(dst_sess: requests.Session) -> dict[tuple[str, str | None], dict]:
     """
-    Try to locate an existing destination page with the same title under the same parent.
+    Index every page of the destination space by (title, direct parent id) with one
+    paginated CQL search, so per-page existence checks need no request.
+    Bodies are reduced to a digest ("_storage_digest") to keep the index small.
     """
-    # First find candidates by title in the space
-    url = (
-        f"{DST_BASE_URL.rstrip('/')}/rest/api/content"
-        f"?type=page&spaceKey={quote(DST_SPACE_KEY)}&title={quote(title)}"
-        f"&expand=ancestors"
-    )
-    r = _req_with_retry(dst_sess, "GET", url)
-    if r.status_code != 200:
-        return None
-    data = r.json()
-    for p in data.get("results", []):
-        ancs = p.get("ancestors", []) or []
-        direct_parent = ancs[-1]["id"] if ancs else None
-        if (parent_id or None) == (direct_parent or None):
-            return p
-    return None
+    params = {
+        "cql": DST_PAGES_CQL,
+        "expand": "ancestors,version,metadata.labels,body.storage",
+        "limit": PAGE_LIMIT,
+    }
+    index: dict[tuple[str, str | None], dict] = {}
+    for p in _paged_get(dst_sess, f"{DST_API}/content/search", params):
+        direct_parent = _parent_id(p)
+        storage = p.pop("body", {}).get("storage", {}).get("value", "") or ""
+        p["_storage_digest"] = _digest(storage)
+        index[(p["title"], direct_parent)] = p
+    return index
+
+# Constant parts of the write requests, built once and merged per call
+_JSON_HDR = {"Content-Type": "application/json"}
+_PAGE_TMPL = {"type": "page", "space": {"key": DST_SPACE_KEY}}
+_COPY_TMPL = {
+    "copyAttachments": False,
+    "copyPermissions": False,
+    "copyProperties": False,
+    "copyLabels": False,
+    "copyCustomContents": False,
+}
+
+def _storage_body(storage_value: str) -> dict:
+    return {"storage": {"value": storage_value, "representation": "storage"}}
 
 def create_page(
     dst_sess: requests.Session,
@@ -144,148 +278,377 @@ def create_page(
     storage_value: str,
     parent_id: str | None
 ) -> dict:
-    body = {
-        "type": "page",
-        "title": title,
-        "space": {"key": DST_SPACE_KEY},
-        "body": {
-            "storage": {
-                "value": storage_value,
-                "representation": "storage"
-            }
-        }
-    }
+    body = _PAGE_TMPL | {"title": title, "body": _storage_body(storage_value)}
     if parent_id:
         body["ancestors"] = [{"id": parent_id}]
 
-    url = f"{DST_BASE_URL.rstrip('/')}/rest/api/content"
-    r = _req_with_retry(dst_sess, "POST", url, json=body,
-                        headers={"Content-Type": "application/json"})
+    url = f"{DST_API}/content"
+    r = dst_sess.post(url, data=_dumps(body),
+                      headers=_JSON_HDR, timeout=TIMEOUT_S)
     r.raise_for_status()
-    return r.json()
+    return _loads(r.content)
+
+def copy_page(
+    dst_sess: requests.Session, page_id: str, title: str, parent_id: str | None
+) -> dict | None:
+    """
+    Server-side copy of an existing destination page (body only) under a new title.
+    Returns None when the copy is refused (e.g. no copy permission, or the
+    endpoint is unavailable) so the caller can create the page instead.
+    """
+    if parent_id:
+        destination = {"type": "parent_page", "value": parent_id}
+    else:
+        destination = {"type": "space", "value": DST_SPACE_KEY}
+    body = _COPY_TMPL | {"destination": destination, "pageTitle": title}
+    url = f"{DST_API}/content/{page_id}/copy"
+    r = dst_sess.post(url, data=_dumps(body),
+                      headers=_JSON_HDR, timeout=TIMEOUT_S)
+    if not r.ok:
+        return None
+    return _loads(r.content)
+
+# (body digest, parent destination id) -> destination page created with that body this run
+_created_bodies: dict[tuple[bytes, str | None], str] = {}
+
+def create_or_clone_page(
+    dst_sess: requests.Session,
+    title: str,
+    storage_value: str,
+    parent_id: str | None,
+    digest: bytes,
+) -> dict:
+    """
+    create_page(), except a large body already created under the same parent this
+    run is copied server-side from that page instead of being uploaded again.
+    """
+    # The threshold is in UTF-8 bytes; there are never fewer bytes than
+    # characters, so only bodies short in characters need encoding to check
+    if len(storage_value) < DEDUP_MIN_BYTES and len(storage_value.encode("utf-8")) < DEDUP_MIN_BYTES:
+        return create_page(dst_sess, title, storage_value, parent_id)
+    key = (digest, parent_id)
+    twin_id = _created_bodies.get(key)
+    if twin_id:
+        copied = copy_page(dst_sess, twin_id, title, parent_id)
+        if copied is not None:
+            return copied
+    created = create_page(dst_sess, title, storage_value, parent_id)
+    _created_bodies[key] = created["id"]
+    return created
 
 def update_page(
     dst_sess: requests.Session, page: dict, new_storage_value: str
 ) -> dict:
     page_id = page["id"]
     version_num = page.get("version", {}).get("number", 1)
-    body = {
+    body = _PAGE_TMPL | {
         "id": page_id,
-        "type": "page",
         "title": page["title"],
-        "space": {"key": DST_SPACE_KEY},
-        "body": {
-            "storage": {
-                "value": new_storage_value,
-                "representation": "storage"
-            }
-        },
-        "version": {"number": version_num + 1}
+        "body": _storage_body(new_storage_value),
+        "version": {"number": version_num + 1},
     }
-    url = f"{DST_BASE_URL.rstrip('/')}/rest/api/content/{page_id}"
-    r = _req_with_retry(dst_sess, "PUT", url, json=body,
-                        headers={"Content-Type": "application/json"})
+    url = f"{DST_API}/content/{page_id}"
+    r = dst_sess.put(url, data=_dumps(body),
+                     headers=_JSON_HDR, timeout=TIMEOUT_S)
     r.raise_for_status()
-    return r.json()
+    return _loads(r.content)
 
-def copy_labels(src_sess: requests.Session, dst_sess: requests.Session, src_id: str, dst_id: str):
-    if not COPY_LABELS:
-        return
+# (destination page id, label set) pairs already posted this run
+_posted_labels: set[tuple[str, frozenset[tuple[str, str]]]] = set()
+
+def _label_key(labels: list[dict]) -> frozenset[tuple[str, str]]:
+    return frozenset((l.get("prefix", "global"), l["name"]) for l in labels if "name" in l)
+
+@lru_cache(maxsize=4096)
+def _label_payload(names: frozenset[tuple[str, str]]) -> tuple[dict, ...]:
+    return tuple({"prefix": prefix, "name": name} for prefix, name in sorted(names))
+
+def fetch_src_labels(src_sess: requests.Session, src_id: str) -> list[dict]:
     # GET labels from source
-    get_url = f"{SRC_BASE_URL.rstrip('/')}/rest/api/content/{src_id}/label"
-    r = _req_with_retry(src_sess, "GET", get_url)
+    get_url = f"{SRC_API}/content/{src_id}/label"
+    r = src_sess.get(get_url, timeout=TIMEOUT_S)
     if r.status_code != 200:
+        return []
+    return _loads(r.content).get("results", [])
+
+def post_labels(
+    dst_sess: requests.Session,
+    dst_id: str,
+    labels: list[dict],
+    dst_labels: frozenset[tuple[str, str]] = frozenset(),
+):
+    key = _label_key(labels)
+    # Nothing to add if the destination already carries every label
+    if not key or key <= dst_labels or (dst_id, key) in _posted_labels:
         return
-    labels = r.json().get("results", [])
-    if not labels:
-        return
-    payload = [{"prefix": l.get("prefix", "global"), "name": l["name"]} for l in labels if "name" in l]
     # POST labels to dest
-    post_url = f"{DST_BASE_URL.rstrip('/')}/rest/api/content/{dst_id}/label"
-    r = _req_with_retry(dst_sess, "POST", post_url, json=payload,
-                        headers={"Content-Type": "application/json"})
+    post_url = f"{DST_API}/content/{dst_id}/label"
+    r = dst_sess.post(post_url, data=_dumps(_label_payload(key)),
+                      headers=_JSON_HDR, timeout=TIMEOUT_S)
+    # ignore non-200 silently
+    if r.ok:
+        _posted_labels.add((dst_id, key))
+
+_CHUNK = 64 * 1024   # attachment bytes held in memory at a time
+
+class _MultipartFile:
+    """
+    multipart/form-data body wrapping one seekable file, read chunk by chunk so
+    the upload never holds the whole file (requests' files= would).
+    Has a length, so it is sent with a Content-Length, and is seekable, so
+    urllib3 can rewind it when it retries the POST.
+    """
+    def __init__(self, filename: str, fileobj: t.BinaryIO):
+        self.boundary = choose_boundary()
+        field = RequestField(name="file", data=b"", filename=filename)
+        field.make_multipart(content_type="application/octet-stream")
+        self._head = f"--{self.boundary}\r\n{field.render_headers()}".encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("ascii")
+        self._file = fileobj
+        self._size = fileobj.seek(0, os.SEEK_END)
+        self.seek(0)
+
+    def __len__(self) -> int:
+        return len(self._head) + self._size + len(self._tail)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, pos: int) -> int:
+        self._pos = pos
+        self._file.seek(min(max(self._pos - len(self._head), 0), self._size))
+        return self._pos
+
+    def read(self, n: int = -1) -> bytes:
+        end = len(self) if n is None or n < 0 else min(len(self), self._pos + n)
+        parts = []
+        file_end = len(self._head) + self._size
+        while self._pos < end:
+            if self._pos < len(self._head):
+                chunk = self._head[self._pos:end]
+            elif self._pos < file_end:
+                chunk = self._file.read(min(end, file_end) - self._pos)
+                if not chunk:
+                    raise OSError(f"attachment file shrank while uploading {self._pos}/{file_end}")
+            else:
+                chunk = self._tail[self._pos - file_end:end - file_end]
+            self._pos += len(chunk)
+            parts.append(chunk)
+        return b"".join(parts)
+
+def _upload_attachment(dst_sess: requests.Session, dst_id: str, filename: str, fileobj: t.BinaryIO):
+    up_url = f"{DST_API}/content/{dst_id}/child/attachment"
+    body = _MultipartFile(filename, fileobj)
+    headers = {
+        "X-Atlassian-Token": "nocheck",  # required for multipart
+        "Content-Type": f"multipart/form-data; boundary={body.boundary}",
+    }
+    r = dst_sess.post(up_url, data=body, headers=headers, timeout=TIMEOUT_S)
     # ignore non-200 silently
 
-def copy_attachments(src_sess: requests.Session, dst_sess: requests.Session, src_id: str, dst_id: str):
-    if not COPY_ATTACHMENTS:
+def _copy_one_attachment(
+    src_sess: requests.Session,
+    dst_sess: requests.Session,
+    att: dict,
+    dst_id: str,
+    cache: SourceCache | None = None,
+):
+    dl_rel = att.get("_links", {}).get("download")
+    filename = att.get("title", "attachment.bin")
+    if not dl_rel:
         return
-    # List attachments on source
-    list_url = (
-        f"{SRC_BASE_URL.rstrip('/')}/rest/api/content/{src_id}/child/attachment"
-        f"?limit={PAGE_LIMIT}"
-    )
-    for att in _paged_get(src_sess, list_url):
+    version = _version(att)
+    # Without a version a cached blob could be stale forever: bypass the cache
+    if cache is not None and "id" in att and version is not None:
+        blob = cache.blob_path(att["id"], version)
+    else:
+        blob = None
+    if blob is None or not os.path.exists(blob):
         # Download
-        dl_rel = att.get("_links", {}).get("download")
-        filename = att.get("title", "attachment.bin")
-        if not dl_rel:
-            continue
-        dl_url = SRC_BASE_URL.rstrip("/") + dl_rel
-        dl = _req_with_retry(src_sess, "GET", dl_url, stream=True)
-        if dl.status_code != 200:
-            continue
-        content = io.BytesIO(dl.content)
-
-        # Upload to destination
-        up_url = f"{DST_BASE_URL.rstrip('/')}/rest/api/content/{dst_id}/child/attachment"
-        headers = {"X-Atlassian-Token": "nocheck"}  # required for multipart
-        files = {"file": (filename, content, "application/octet-stream")}
-        r = _req_with_retry(dst_sess, "POST", up_url, files=files, headers=headers)
-        # ignore non-200 silently
+        dl_url = SRC_ROOT + dl_rel
+        with src_sess.get(dl_url, stream=True, timeout=TIMEOUT_S) as dl:
+            if dl.status_code != 200:
+                return
+            # Copy the stream in _CHUNK pieces instead of materializing dl.content
+            dl.raw.decode_content = True
+            if blob is None:
+                # dl.raw cannot be rewound for a retried upload: spool it, to
+                # disk past _CHUNK bytes
+                with tempfile.SpooledTemporaryFile(max_size=_CHUNK) as spool:
+                    shutil.copyfileobj(dl.raw, spool, _CHUNK)
+                    _upload_attachment(dst_sess, dst_id, filename, spool)
+                return
+            # Write then rename, so an interrupted run never leaves a partial blob
+            tmp = f"{blob}.part.{threading.get_ident()}"
+            try:
+                with open(tmp, "wb") as f:
+                    shutil.copyfileobj(dl.raw, f, _CHUNK)
+                os.replace(tmp, blob)
+                cache.prune_blobs(att["id"], version)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
 
-def run_copy():
-    src = _session(SRC_USERNAME, SRC_API_TOKEN)
-    dst = _session(DST_USERNAME, DST_API_TOKEN)
+    # Upload to destination from the cached blob
+    with open(blob, "rb") as f:
+        _upload_attachment(dst_sess, dst_id, filename, f)
 
-    print(f"Reading pages from space '{SRC_SPACE_KEY}' at {SRC_BASE_URL} ...")
-    pages = fetch_all_pages_from_space(src)
-    if not pages:
-        print("No pages found. Nothing to do.")
+def list_src_attachments(src_sess: requests.Session, src_id: str) -> list[dict]:
+    list_url = f"{SRC_API}/content/{src_id}/child/attachment"
+    return list(_paged_get(src_sess, list_url, {"expand": "version", "limit": PAGE_LIMIT}))
+
+def copy_attachments(
+    src_sess: requests.Session,
+    dst_sess: requests.Session,
+    attachments: list[dict],
+    dst_id: str,
+    att_pool: Executor,
+    cache: SourceCache | None = None,
+):
+    if not attachments:
         return
+    # Attachments are independent: overlap their download/upload round-trips.
+    # `att_pool` is shared by all pages, so ATTACHMENT_WORKERS caps the transfers
+    # in flight (and the memory they hold) for the whole run.
+    # Both sessions are shared; their adapters pool connections across threads.
+    list(att_pool.map(lambda att: _copy_one_attachment(src_sess, dst_sess, att, dst_id, cache), attachments))
+
+def process_page(
+    src: requests.Session,
+    dst: requests.Session,
+    p: dict,
+    id_map: dict[str, str],
+    dest_index: dict[tuple[str, str | None], dict],
+    aux: Executor,
+    att_pool: Executor,
+    cache: SourceCache | None = None,
+) -> str:
+    """
+    Copy one source page (plus labels & attachments); returns the destination page id.
+    `aux` runs the source-side label/attachment lookups alongside the page write;
+    `att_pool` copies the attachments.
+    """
+    src_id    = p["id"]
+    title     = p["title"]
+    storage   = page_storage(src, p, cache)
+    parent_src_id = _parent_id(p)
+    parent_dst_id = id_map.get(parent_src_id) if parent_src_id else None
+
+    digest = _digest(storage)
+
+    existing = dest_index.get((title, parent_dst_id))
+    if existing and ON_TITLE_CONFLICT == "skip":
+        print(f"SKIP (exists)  {title}")
+        return existing["id"]
+
+    # The source side only needs src_id: read labels & the attachment list
+    # while the destination page is being written.
+    labels_f = aux.submit(fetch_src_labels, src, src_id) if COPY_LABELS else None
+    atts_f = aux.submit(list_src_attachments, src, src_id) if COPY_ATTACHMENTS else None
+
+    dst_labels: frozenset[tuple[str, str]] = frozenset()
+    if existing and ON_TITLE_CONFLICT == "update":
+        if existing.get("_storage_digest") == digest:
+            # Same body: no PUT, so no new version; labels & attachments still sync
+            print(f"NOCHANGE       {title}")
+            written = existing
+        else:
+            print(f"UPDATE         {title}")
+            written = update_page(dst, existing, storage)
+        dst_labels = _label_key(
+            existing.get("metadata", {}).get("labels", {}).get("results", [])
+        )
+    elif existing:  # append-suffix
+        title = f"{title} (copy)"
+        print(f"CREATE(+suffix){title}")
+        written = create_or_clone_page(dst, title, storage, parent_dst_id, digest)
+    else:
+        print(f"CREATE         {title}")
+        written = create_or_clone_page(dst, title, storage, parent_dst_id, digest)
+    dst_id = written["id"]
+    # keep the index in sync so later lookups see what this run wrote
+    written["_storage_digest"] = digest
+    dest_index[(title, parent_dst_id)] = written
+
+    # Copy labels & attachments
+    if labels_f is not None:
+        post_labels(dst, dst_id, labels_f.result(), dst_labels)
+    if atts_f is not None:
+        copy_attachments(src, dst, atts_f.result(), dst_id, att_pool, cache)
+    return dst_id
 
-    # sort by depth so parents are created before children
-    pages = sort_pages_parent_first(pages)
+def run_copy():
+    src = _session(SRC_USERNAME, SRC_API_TOKEN)
+    dst = _session(DST_USERNAME, DST_API_TOKEN)
+    cache = SourceCache(CACHE_DIR, SRC_ROOT, SRC_SPACE_KEY) if USE_CACHE else None
+    try:
+        _run_copy(src, dst, cache)
+    finally:
+        if cache is not None:
+            cache.close()
 
+def _run_copy(src: requests.Session, dst: requests.Session, cache: SourceCache | None):
+    # (title, parent destination id) -> existing destination page
+    dest_index = prefetch_dest_index(dst)
     # Map source page id -> destination page id
     id_map: dict[str, str] = {}
+    # Source parent id -> pages listed before their parent was copied
+    pending: dict[str, list[dict]] = defaultdict(list)
+    in_flight: dict[Future, dict] = {}
+    finished: queue.SimpleQueue[Future] = queue.SimpleQueue()
+    listed: set[str] = set()
 
+    print(f"Reading pages from space '{SRC_SPACE_KEY}' at {SRC_BASE_URL} ...")
     # Optionally, detect an existing space home page in destination to use as logical root
     # (not required; we rely on ancestors mapping).
-    for p in pages:
-        src_id    = p["id"]
-        title     = p["title"]
-        storage   = p.get("body", {}).get("storage", {}).get("value", "") or ""
-        ancestors = p.get("ancestors", []) or []
-        parent_src_id = ancestors[-1]["id"] if ancestors else None
-        parent_dst_id = id_map.get(parent_src_id) if parent_src_id else None
-
-        existing = find_dest_page_by_title(dst, title, parent_dst_id)
-        if existing:
-            if ON_TITLE_CONFLICT == "skip":
-                print(f"SKIP (exists)  {title}")
-                id_map[src_id] = existing["id"]
-                continue
-            elif ON_TITLE_CONFLICT == "update":
-                print(f"UPDATE         {title}")
-                updated = update_page(dst, existing, storage)
-                id_map[src_id] = updated["id"]
-            else:  # append-suffix
-                title = f"{title} (copy)"
-                print(f"CREATE(+suffix){title}")
-                created = create_page(dst, title, storage, parent_dst_id)
-                id_map[src_id] = created["id"]
-        else:
-            print(f"CREATE         {title}")
-            created = create_page(dst, title, storage, parent_dst_id)
-            id_map[src_id] = created["id"]
+    # Pages on `ex`; their source-side label/attachment lookups on `aux`
+    # (up to two per page) and their attachments on `att_pool`. `ex` is shut
+    # down first so the other two outlive every page.
+    with ThreadPoolExecutor(max_workers=2 * MAX_WORKERS) as aux, \
+         ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS) as att_pool, \
+         ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        def submit(p: dict):
+            fut = ex.submit(process_page, src, dst, p, id_map, dest_index, aux, att_pool, cache)
+            in_flight[fut] = p
+            fut.add_done_callback(finished.put)
+
+        def reap(fut: Future):
+            p = in_flight.pop(fut)
+            id_map[p["id"]] = fut.result()
+            # Parents are created before children: release the ones waiting on p
+            for child in pending.pop(p["id"], ()):
+                submit(child)
+
+        try:
+            # Copy pages while the listing streams in, instead of holding the whole space
+            for p in iter_pages_from_space(src, cache):
+                listed.add(p["id"])
+                parent = _parent_id(p)
+                if parent is None or parent in id_map:
+                    submit(p)
+                else:
+                    pending[parent].append(p)
+                # Reap finished pages; block while the pool is saturated so the
+                # listing is not read far ahead of the copy.
+                while not finished.empty() or len(in_flight) >= 2 * MAX_WORKERS:
+                    reap(finished.get())
 
-        # Copy labels & attachments
-        dst_id = id_map[src_id]
-        if COPY_LABELS:
-            copy_labels(src, dst, src_id, dst_id)
-        if COPY_ATTACHMENTS:
-            copy_attachments(src, dst, src_id, dst_id)
+            # Parents never listed (e.g. restricted): copy their children as roots.
+            # Deeper pages still wait in `pending` and follow through reap().
+            for parent in [pid for pid in pending if pid not in listed]:
+                for child in pending.pop(parent):
+                    submit(child)
+            while in_flight:
+                reap(finished.get())
+        except BaseException:
+            for fut in in_flight:
+                fut.cancel()
+            raise
 
+    if not listed:
+        print("No pages found. Nothing to do.")
+        return
     print("✅ Done. Copied pages:", len(id_map))
     print(f"Destination space: {DST_SPACE_KEY} at {DST_BASE_URL}")
 